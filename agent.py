@@ -1,32 +1,437 @@
-from openai import OpenAI
-import dspy
-from typing import List, Dict, Any, Optional
-import json
+from openai import OpenAI, AsyncOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient, RateLimitError, APITimeoutError, APIConnectionError, InternalServerError, BadRequestError, UnprocessableEntityError
+import httpx
+import orjson
+from tenacity import retry, retry_if_exception_type, wait_random_exponential, stop_after_attempt
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+from functools import cached_property
+from typing import TYPE_CHECKING, AsyncIterator, List, Dict, Any, Optional, Tuple, Hashable, Callable, Union
+import asyncio
+import base64
+import hashlib
+import io
 import os
+import threading
+import time
 from dotenv import load_dotenv
+from batching import MicroBatcher
+
+if TYPE_CHECKING:
+    import numpy as np
 
 # Load environment variables
 load_dotenv()
 
+# Se lee una sola vez al importar; get_agent() valida que exista
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
-# ============= TOOLS =============
 
-class AnalyzeFoodTool:
-    name = "analyze_food_image"
-    description = "Analiza una imagen de comida para identificar el plato, ingredientes, receta y datos curiosos"
+# Clientes compartidos: se crean una sola vez y se reutilizan en todas las llamadas
+# para aprovechar el pool de conexiones (keep-alive / TLS) de httpx.
+# Con HTTP/2 las peticiones concurrentes se multiplexan sobre pocas conexiones
+# en lugar de abrir un socket + handshake TLS por cada una.
+_HTTP_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=50)
+# Timeout por operación (no total): el default del SDK es 600 s, demasiado para una API
+# interactiva. Las llamadas batch lo escalan por número de elementos.
+_HTTP_TIMEOUT = httpx.Timeout(30.0, connect=5.0)
+
+_client: Optional[OpenAI] = None
+_async_client: Optional[AsyncOpenAI] = None
+_client_lock = threading.Lock()
+
+
+def _get_client() -> OpenAI:
+    global _client
+
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = OpenAI(
+                    api_key=OPENAI_API_KEY,
+                    max_retries=0,
+                    timeout=_HTTP_TIMEOUT,
+                    http_client=DefaultHttpxClient(http2=True, limits=_HTTP_LIMITS),
+                )
+
+    return _client
+
+
+def _get_async_client() -> AsyncOpenAI:
+    global _async_client
+
+    if _async_client is None:
+        with _client_lock:
+            if _async_client is None:
+                _async_client = AsyncOpenAI(
+                    api_key=OPENAI_API_KEY,
+                    max_retries=0,
+                    timeout=_HTTP_TIMEOUT,
+                    http_client=DefaultAsyncHttpxClient(http2=True, limits=_HTTP_LIMITS),
+                )
+
+    return _async_client
+
+
+async def aclose_clients() -> None:
+    """Cierra los pools de conexiones compartidos (shutdown de la API)."""
+    global _client, _async_client
+
+    with _client_lock:
+        client, async_client = _client, _async_client
+        _client = _async_client = None
+
+    if client is not None:
+        client.close()
+    if async_client is not None:
+        await async_client.close()
+
+
+# Los wrappers síncronos no usan asyncio.run(): cada llamada crearía y cerraría un
+# event loop, y las conexiones del pool de _async_client quedarían ligadas a un loop
+# ya cerrado. En su lugar todas se ejecutan en un único loop de fondo persistente.
+_sync_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def _run_sync(coro):
+    global _sync_loop
+
+    if _sync_loop is None:
+        with _client_lock:
+            if _sync_loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="food-agent-loop", daemon=True).start()
+                _sync_loop = loop
+
+    return asyncio.run_coroutine_threadsafe(coro, _sync_loop).result()
+
+
+# Reintentos con backoff exponencial + jitter solo para errores transitorios de la API
+# (los clientes usan max_retries=0 para que esta sea la única política de reintento)
+_retry_transient = retry(
+    retry=retry_if_exception_type((RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)),
+    wait=wait_random_exponential(min=1, max=20),
+    stop=stop_after_attempt(5),
+    reraise=True
+)
+
+
+def _parse_json(content: str) -> Dict[str, Any]:
+    # Las llamadas usan response_format json_object / json_schema: el contenido ya es JSON puro
+    return orjson.loads(content)
+
+
+def _parse_batch_results(content: str, expected: int, label: str) -> List[Dict[str, Any]]:
+    # Respuesta de un prompt por lotes: {"results": [{"index": i, ...}, ...]}. Cada resultado
+    # se entrega a la petición de su posición, así que los índices deben ser exactamente
+    # 0..n-1 (uno repetido o ausente le daría a una petición el resultado de otra)
+    results = sorted(_parse_json(content)["results"], key=lambda r: r.get("index", -1))
+    if [r.get("index") for r in results] != list(range(expected)):
+        raise ValueError(f"Se esperaban los {label} 0..{expected - 1} y se recibieron "
+                         f"{[r.get('index') for r in results]}")
     
-    def __call__(self, image_base64: str, context: str = "") -> Dict[str, Any]:
-        client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    for result in results:
+        result.pop("index", None)
+    return results
+
+
+async def _astream_json(on_text: Optional[Callable[[str], None]] = None, **create_kwargs) -> Dict[str, Any]:
+    # Recibe la respuesta en streaming acumulando los fragmentos en una lista (sin
+    # concatenar strings) y solo intenta parsear cuando un fragmento termina en "}"
+    stream = await _acreate(stream=True, **create_kwargs)
+    chunks: List[str] = []
+    
+    async for chunk in stream:
+        if not chunk.choices or not chunk.choices[0].delta.content:
+            continue
         
-        vision_response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": """Analiza esta imagen de comida y proporciona:
+        text = chunk.choices[0].delta.content
+        chunks.append(text)
+        if on_text:
+            on_text(text)
+        
+        if text.rstrip().endswith("}"):
+            try:
+                data = _parse_json("".join(chunks))
+            except orjson.JSONDecodeError:
+                continue
+            await stream.close()
+            return data
+    
+    return _parse_json("".join(chunks))
+
+
+# ============= RATE LIMITING =============
+
+# Límites de la cuenta de OpenAI; el limiter es uno por proceso, igual que los clientes
+OPENAI_RPM = int(os.getenv("OPENAI_RPM", "500"))
+OPENAI_TPM = int(os.getenv("OPENAI_TPM", "200000"))
+
+# Tokens de entrada estimados por imagen (detail auto, lado máximo 1024 px)
+_IMAGE_TOKENS_ESTIMATE = 1000
+
+
+class _RateLimiter:
+    """
+    Token bucket doble (peticiones y tokens por minuto) para repartir llamadas
+    concurrentes sin superar los límites RPM/TPM de OpenAI.
+    
+    Cada llamada reserva su cupo al instante (el saldo puede quedar negativo) y espera
+    fuera del lock lo que tarde en reponerse: el orden de llegada se respeta y el mismo
+    limiter sirve al event loop de la API, al de los wrappers síncronos y a hilos.
+    """
+    
+    def __init__(self, rpm: int, tpm: int):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._available_requests = float(rpm)
+        self._available_tokens = float(tpm)
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        self._available_requests = min(self.rpm, self._available_requests + elapsed * self.rpm / 60)
+        self._available_tokens = min(self.tpm, self._available_tokens + elapsed * self.tpm / 60)
+    
+    def _reserve(self, tokens: int) -> float:
+        # Devuelve los segundos que hay que esperar antes de enviar la petición
+        with self._lock:
+            self._refill()
+            self._available_requests -= 1
+            self._available_tokens -= min(tokens, self.tpm)
+            return max(
+                -self._available_requests * 60 / self.rpm,
+                -self._available_tokens * 60 / self.tpm,
+                0.0
+            )
+    
+    async def acquire(self, tokens: int) -> None:
+        wait = self._reserve(tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+    
+    def acquire_blocking(self, tokens: int) -> None:
+        wait = self._reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+
+_rate_limiter = _RateLimiter(OPENAI_RPM, OPENAI_TPM)
+
+
+def _estimate_tokens(create_kwargs: Dict[str, Any]) -> int:
+    # Cota aproximada de lo que consume la llamada: respuesta máxima + prompt
+    # (~4 caracteres por token de texto y un costo fijo por imagen)
+    tokens = create_kwargs.get("max_tokens", 0)
+    for message in create_kwargs["messages"]:
+        content = message["content"]
+        if isinstance(content, str):
+            tokens += len(content) // 4
+            continue
+        for part in content:
+            tokens += _IMAGE_TOKENS_ESTIMATE if part["type"] == "image_url" else len(part["text"]) // 4
+    return tokens
+
+
+def _create(**create_kwargs):
+    _rate_limiter.acquire_blocking(_estimate_tokens(create_kwargs))
+    return _get_client().chat.completions.create(**create_kwargs)
+
+
+async def _acreate(**create_kwargs):
+    await _rate_limiter.acquire(_estimate_tokens(create_kwargs))
+    return await _get_async_client().chat.completions.create(**create_kwargs)
+
+
+# ============= CACHE =============
+
+class _LRUCache:
+    """Cache exacto acotado (LRU) para respuestas del agente."""
+    
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self._data: "OrderedDict[Hashable, Any]" = OrderedDict()
+    
+    def get(self, key: Hashable) -> Optional[Any]:
+        if key not in self._data:
+            return None
+        self._data.move_to_end(key)
+        return self._data[key]
+    
+    def set(self, key: Hashable, value: Any) -> None:
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+
+def _ingredients_key(ingredients: List[str]) -> Tuple[str, ...]:
+    # Clave independiente del orden, mayúsculas y espacios ("Ajo, sal" == "sal,ajo")
+    return tuple(sorted(ingredient.strip().lower() for ingredient in ingredients))
+
+
+class _SemanticCache:
+    """
+    Cache semántico: reutiliza una respuesta si la consulta es casi idéntica a una
+    anterior (similitud coseno entre embeddings >= threshold). Solo se comparan entradas
+    con la misma clave exacta (p. ej. los mismos ingredientes): el embedding decide
+    únicamente entre variantes del nombre ("tacos al pastor" ~ "Taco al pastor").
+    """
+    
+    EMBEDDING_MODEL = "text-embedding-3-small"
+    
+    def __init__(self, threshold: float = 0.95, maxsize: int = 512):
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self._vectors: Optional["np.ndarray"] = None
+        self._keys: List[Hashable] = []
+        self._values: List[Any] = []
+    
+    def has_key(self, key: Hashable) -> bool:
+        # Sin entradas con esta clave no puede haber hit: no hace falta esperar al embedding
+        return key in self._keys
+    
+    async def embed(self, text: str) -> Optional["np.ndarray"]:
+        # Un fallo del embedding cuenta como miss (y la entrada no se cachea)
+        try:
+            response = await _get_async_client().embeddings.create(model=self.EMBEDDING_MODEL, input=text)
+        except Exception:
+            return None
+        
+        import numpy as np
+        
+        vector = np.asarray(response.data[0].embedding, dtype=np.float32)
+        vector /= np.linalg.norm(vector)
+        return vector
+    
+    def match(self, vector: Optional["np.ndarray"], key: Hashable) -> Optional[Any]:
+        if vector is None or self._vectors is None:
+            return None
+        
+        import numpy as np
+        
+        scores = self._vectors @ vector
+        scores[[k != key for k in self._keys]] = -1.0
+        best = int(np.argmax(scores))
+        if scores[best] >= self.threshold:
+            return self._values[best]
+        return None
+    
+    def add(self, vector: Optional["np.ndarray"], key: Hashable, value: Any) -> None:
+        if vector is None:
+            return
+        
+        import numpy as np
+        
+        if self._vectors is None:
+            self._vectors = vector[np.newaxis, :]
+        else:
+            if len(self._values) >= self.maxsize:
+                # Lleno: se descarta la entrada más antigua
+                self._vectors = self._vectors[1:]
+                del self._keys[0]
+                del self._values[0]
+            self._vectors = np.vstack([self._vectors, vector])
+        self._keys.append(key)
+        self._values.append(value)
+
+
+# ============= IMAGES =============
+
+# Resolución efectiva de gpt-4o-mini: más píxeles solo agrandan el payload y los tokens de imagen
+IMAGE_MAX_SIDE = int(os.getenv("FOOD_IMAGE_MAX_SIDE", "1024"))
+IMAGE_JPEG_QUALITY = int(os.getenv("FOOD_IMAGE_JPEG_QUALITY", "85"))
+# "low" fija el coste en 85 tokens por imagen (512 px); "auto"/"high" usan tiles de 512 px
+IMAGE_DETAIL = os.getenv("FOOD_IMAGE_DETAIL", "auto")
+# Agrupar análisis concurrentes de distintas peticiones en un solo prompt multi-imagen
+# (opt-in): reduce llamadas, pero cada usuario espera a que el modelo escriba los N análisis
+# y sus fotos comparten prompt con las de otros. 1 = desactivado (una llamada por imagen)
+VISION_BATCH_SIZE = int(os.getenv("FOOD_VISION_BATCH_SIZE", "1"))
+
+# Data URLs ya codificados, para no repetir el base64 de la misma imagen en reintentos
+_IMAGE_URL_CACHE = _LRUCache(maxsize=32)
+
+
+class InvalidImageError(Exception):
+    """Imagen con firma válida que PIL no puede decodificar (corrupta o truncada)."""
+    
+    def __init__(self):
+        super().__init__("No se pudo procesar la imagen")
+
+
+def _preprocess_image(raw: bytes) -> bytes:
+    # Reduce la imagen al lado máximo configurado y la re-codifica como JPEG
+    # (PIL se importa aquí: solo se necesita cuando llega una imagen)
+    from PIL import Image, ImageOps
+    
+    # UnidentifiedImageError y los errores de archivo truncado son OSError; los plugins
+    # de PIL usan SyntaxError para estructuras rotas
+    try:
+        img = Image.open(io.BytesIO(raw))
+        if img.format == "JPEG" and max(img.size) <= IMAGE_MAX_SIDE:
+            return raw
+        
+        # JPEG: libjpeg escala la DCT al decodificar (1/2, 1/4, 1/8) hasta quedar justo por
+        # encima del lado máximo, sin decodificar todos los píxeles de una foto de móvil
+        img.draft("RGB", (IMAGE_MAX_SIDE, IMAGE_MAX_SIDE))
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE), Image.Resampling.LANCZOS)
+        buf = io.BytesIO()
+        img.convert("RGB").save(buf, "JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True)
+        return buf.getvalue()
+    except (OSError, SyntaxError, Image.DecompressionBombError) as e:
+        raise InvalidImageError() from e
+
+
+def _image_digest(data: bytes) -> str:
+    # SHA-256 de OpenSSL usa las extensiones SHA-NI / ARMv8 SHA2 cuando existen
+    # (~2x más rápido que blake2b, que no tiene aceleración por hardware)
+    return hashlib.sha256(data).hexdigest()
+
+
+def _encode_image(raw: bytes) -> str:
+    return "data:image/jpeg;base64," + base64.b64encode(_preprocess_image(raw)).decode("ascii")
+
+
+def _image_data_url(image: Union[bytes, str], digest: Optional[str] = None) -> str:
+    # Acepta bytes crudos (se codifican una sola vez), un string en base64, un data URL
+    # ya construido o una URL http(s); `digest` evita volver a hashear bytes cuyo hash ya se conoce.
+    # Una imagen ya publicada (p. ej. URL firmada de un bucket) se envía por referencia:
+    # OpenAI la descarga directamente y el cuerpo de la petición no lleva ~33% extra de base64
+    if isinstance(image, str):
+        if image.startswith(("data:", "https://", "http://")):
+            return image
+        return f"data:image/jpeg;base64,{image}"
+    
+    key = digest or _image_digest(image)
+    url = _IMAGE_URL_CACHE.get(key)
+    if url is None:
+        url = _encode_image(image)
+        _IMAGE_URL_CACHE.set(key, url)
+    return url
+
+
+async def _aimage_data_url(image: Union[bytes, str], digest: Optional[str] = None) -> str:
+    # Igual que _image_data_url, pero el decode + resize + JPEG (CPU puro, PIL libera el GIL)
+    # se hace en un hilo: una foto de móvil no bloquea el event loop durante la reducción
+    if isinstance(image, str):
+        return _image_data_url(image)
+    
+    key = digest or _image_digest(image)
+    url = _IMAGE_URL_CACHE.get(key)
+    if url is None:
+        url = await asyncio.to_thread(_encode_image, image)
+        _IMAGE_URL_CACHE.set(key, url)
+    return url
+
+
+# ============= PROMPTS =============
+# Plantillas invariantes a nivel de módulo: solo se formatean los huecos variables,
+# que van al final para que el prefijo del prompt sea idéntico entre llamadas.
+
+_ANALYZE_PROMPT = """Analiza esta imagen de comida y proporciona:
 1. Nombre del plato
 2. Lista de ingredientes principales (como lista de strings)
 3. Pasos de la receta (como lista de strings)
@@ -37,32 +442,228 @@ Responde en formato JSON con esta estructura exacta:
     "dish_name": "nombre del plato",
     "ingredients": ["ingrediente1", "ingrediente2", ...],
     "recipe_steps": ["paso1", "paso2", ...],
-    "fun_facts": ["dato1", "dato2", ...]
+    "fun_facts": ["dato1", "dato2", ...],
+    "reasoning": "breve explicación de qué elementos visuales te llevaron a identificar el plato"
 }"""
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{image_base64}"
-                            }
-                        }
-                    ]
+
+_ANALYZE_BATCH_PROMPT = """Analiza cada una de las imágenes de comida numeradas a continuación y, para cada una, proporciona:
+1. Nombre del plato
+2. Lista de ingredientes principales (como lista de strings)
+3. Pasos de la receta (como lista de strings)
+4. 3-5 datos curiosos sobre el plato (como lista de strings)
+
+Responde en formato JSON con una entrada por imagen, en el mismo orden (campo "index"):
+{
+    "results": [
+        {
+            "index": número_de_la_imagen,
+            "dish_name": "nombre del plato",
+            "ingredients": ["ingrediente1", "ingrediente2", ...],
+            "recipe_steps": ["paso1", "paso2", ...],
+            "fun_facts": ["dato1", "dato2", ...],
+            "reasoning": "breve explicación de qué elementos visuales te llevaron a identificar el plato"
+        }
+    ]
+}"""
+
+# Structured Outputs (json_schema estricto) para el análisis de imágenes: la decodificación
+# queda restringida al esquema, así que la respuesta siempre trae todos los campos
+_ANALYSIS_PROPERTIES = {
+    "dish_name": {"type": "string"},
+    "ingredients": {"type": "array", "items": {"type": "string"}},
+    "recipe_steps": {"type": "array", "items": {"type": "string"}},
+    "fun_facts": {"type": "array", "items": {"type": "string"}},
+    "reasoning": {"type": "string"}
+}
+
+# Orden de los campos en la respuesta (ver FoodAnalyzerAgent.analyze_image_stream)
+_ANALYSIS_FIELDS = tuple(_ANALYSIS_PROPERTIES)
+
+_ANALYZE_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "food_analysis",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": _ANALYSIS_PROPERTIES,
+            "required": list(_ANALYSIS_PROPERTIES),
+            "additionalProperties": False
+        }
+    }
+}
+
+_ANALYZE_BATCH_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "food_analysis_batch",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "results": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {"index": {"type": "integer"}, **_ANALYSIS_PROPERTIES},
+                        "required": ["index", *_ANALYSIS_PROPERTIES],
+                        "additionalProperties": False
+                    }
                 }
-            ],
-            max_tokens=1000
+            },
+            "required": ["results"],
+            "additionalProperties": False
+        }
+    }
+}
+
+# Clave de enrutado de la caché de prefijos de OpenAI: las peticiones con el mismo
+# prefijo (mensaje system + instrucciones) van a la misma réplica y reutilizan su prefill
+_ANALYZE_CACHE_KEY = "food-analyzer:analyze"
+
+_NUTRITION_SYSTEM_PROMPT = "Eres un experto nutricionista. Proporciona estimaciones nutricionales precisas y realistas."
+
+_NUTRITION_PROMPT_TMPL = """Calcula la información nutricional para una porción estándar del plato indicado al final.
+
+Responde en formato JSON con esta estructura:
+{{
+    "serving_size": "tamaño de la porción (ej: 1 plato, 200g)",
+    "calories": número_de_calorías,
+    "proteins": gramos_de_proteína,
+    "carbs": gramos_de_carbohidratos,
+    "fats": gramos_de_grasas,
+    "fiber": gramos_de_fibra,
+    "notes": "notas adicionales relevantes",
+    "reasoning": "breve explicación de cómo estimaste los valores a partir de los ingredientes"
+}}
+
+Plato: {dish_name}
+Ingredientes: {ingredients}"""
+
+_NUTRITION_BATCH_PROMPT_TMPL = """Calcula la información nutricional para una porción estándar de cada uno de los platos listados al final.
+
+Responde en formato JSON con una entrada por plato, en el mismo orden (campo "index"):
+{{
+    "results": [
+        {{
+            "index": número_del_plato,
+            "serving_size": "tamaño de la porción (ej: 1 plato, 200g)",
+            "calories": número_de_calorías,
+            "proteins": gramos_de_proteína,
+            "carbs": gramos_de_carbohidratos,
+            "fats": gramos_de_grasas,
+            "fiber": gramos_de_fibra,
+            "notes": "notas adicionales relevantes"
+        }}
+    ]
+}}
+
+{dishes}"""
+
+_COMPARE_SYSTEM_PROMPT = "Eres un experto en gastronomía comparativa y análisis culinario transcultural."
+
+_COMPARE_PROMPT_TMPL = """Compara en detalle los dos platos indicados al final.
+
+Responde en formato JSON:
+{{
+    "similarity_score": número_del_0_al_100,
+    "common_ingredients": ["ingrediente1", "ingrediente2"],
+    "unique_to_dish1": ["ingrediente_exclusivo_1"],
+    "unique_to_dish2": ["ingrediente_exclusivo_1"],
+    "culinary_relationship": "descripción de la relación culinaria entre ambos platos",
+    "cultural_context": "contexto cultural y origen de cada plato",
+    "key_differences": ["diferencia1", "diferencia2", "diferencia3"],
+    "reasoning": "breve explicación de cómo llegaste a esta comparación"
+}}
+
+Plato 1: {dish1_name}
+Ingredientes: {dish1_ingredients}
+
+Plato 2: {dish2_name}
+Ingredientes: {dish2_ingredients}"""
+
+
+# ============= TOOLS =============
+
+class AnalyzeFoodTool:
+    name = "analyze_food_image"
+    description = "Analiza una imagen de comida para identificar el plato, ingredientes, receta y datos curiosos"
+    
+    def _messages(self, image: Union[bytes, str]) -> List[Dict[str, Any]]:
+        # Instrucciones invariantes en el mensaje system; la imagen (lo único que cambia
+        # entre peticiones) va al final, así todo lo anterior es un prefijo cacheable
+        return [
+            {"role": "system", "content": _ANALYZE_PROMPT},
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": _image_data_url(image),
+                            "detail": IMAGE_DETAIL
+                        }
+                    }
+                ]
+            }
+        ]
+    
+    @_retry_transient
+    def __call__(self, image: Union[bytes, str], context: str = "") -> Dict[str, Any]:
+        vision_response = _create(
+            model="gpt-4o-mini",
+            response_format=_ANALYZE_RESPONSE_FORMAT,
+            messages=self._messages(image),
+            max_tokens=1000,
+            prompt_cache_key=_ANALYZE_CACHE_KEY
         )
         
-        content = vision_response.choices[0].message.content
+        return _parse_json(vision_response.choices[0].message.content)
+    
+    @_retry_transient
+    async def acall(self, image: Union[bytes, str], context: str = "",
+                    on_text: Optional[Callable[[str], None]] = None) -> Dict[str, Any]:
+        return await self.astream(image, on_text)
+    
+    async def astream(self, image: Union[bytes, str],
+                      on_text: Optional[Callable[[str], None]] = None) -> Dict[str, Any]:
+        # Sin reintentos: si el texto ya se reenvió al cliente (SSE), un reintento
+        # mezclaría dos respuestas en el mismo stream
+        return await _astream_json(
+            on_text,
+            model="gpt-4o-mini",
+            response_format=_ANALYZE_RESPONSE_FORMAT,
+            messages=self._messages(image),
+            max_tokens=1000,
+            prompt_cache_key=_ANALYZE_CACHE_KEY
+        )
+
+
+    # ----- Batch: varias imágenes en un solo prompt (ver batching.MicroBatcher) -----
+    
+    def _batch_messages(self, images: List[Union[bytes, str]]) -> List[Dict[str, Any]]:
+        content: List[Dict[str, Any]] = []
+        for i, image in enumerate(images):
+            content.append({"type": "text", "text": f"Imagen {i}:"})
+            content.append({"type": "image_url", "image_url": {"url": _image_data_url(image), "detail": IMAGE_DETAIL}})
         
-        # Extract JSON from response (handle markdown code blocks)
-        if "```json" in content:
-            json_str = content.split("```json")[1].split("```")[0].strip()
-        elif "```" in content:
-            json_str = content.split("```")[1].split("```")[0].strip()
-        else:
-            json_str = content.strip()
+        return [
+            {"role": "system", "content": _ANALYZE_BATCH_PROMPT},
+            {"role": "user", "content": content}
+        ]
+    
+    @_retry_transient
+    async def abatch(self, images: List[Union[bytes, str]]) -> List[Dict[str, Any]]:
+        response = await _acreate(
+            model="gpt-4o-mini",
+            response_format=_ANALYZE_BATCH_RESPONSE_FORMAT,
+            messages=self._batch_messages(images),
+            prompt_cache_key=_ANALYZE_CACHE_KEY,
+            max_tokens=min(1000 * len(images), 16000),
+            timeout=_HTTP_TIMEOUT.read * len(images)
+        )
         
-        return json.loads(json_str)
+        return _parse_batch_results(response.choices[0].message.content, len(images), "análisis")
 
 
 class NutritionCalculatorTool:
@@ -70,50 +671,64 @@ class NutritionCalculatorTool:
     name = "calculate_nutrition"
     description = "Calcula información nutricional de un plato basándose en sus ingredientes"
     
-    def __call__(self, dish_name: str, ingredients: List[str]) -> Dict[str, Any]:
-        client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-        
-        ingredients_str = ", ".join(ingredients) if ingredients else "ingredientes estándar"
+    def _messages(self, dish_name: str, ingredients: Union[List[str], str]) -> List[Dict[str, str]]:
+        if isinstance(ingredients, str):
+            ingredients_str = ingredients
+        else:
+            ingredients_str = ", ".join(ingredients) if ingredients else "ingredientes estándar"
         
-        response = client.chat.completions.create(
+        return [
+            {"role": "system", "content": _NUTRITION_SYSTEM_PROMPT},
+            {
+                "role": "user",
+                "content": _NUTRITION_PROMPT_TMPL.format(dish_name=dish_name, ingredients=ingredients_str)
+            }
+        ]
+    
+    @_retry_transient
+    def __call__(self, dish_name: str, ingredients: Union[List[str], str]) -> Dict[str, Any]:
+        response = _create(
             model="gpt-4o-mini",
-            messages=[
-                {
-                    "role": "system",
-                    "content": "Eres un experto nutricionista. Proporciona estimaciones nutricionales precisas y realistas."
-                },
-                {
-                    "role": "user",
-                    "content": f"""Calcula la información nutricional para una porción estándar de:
-
-Plato: {dish_name}
-Ingredientes: {ingredients_str}
-
-Responde en formato JSON con esta estructura:
-{{
-    "serving_size": "tamaño de la porción (ej: 1 plato, 200g)",
-    "calories": número_de_calorías,
-    "proteins": gramos_de_proteína,
-    "carbs": gramos_de_carbohidratos,
-    "fats": gramos_de_grasas,
-    "fiber": gramos_de_fibra,
-    "notes": "notas adicionales relevantes"
-}}"""
-                }
-            ],
+            response_format={"type": "json_object"},
+            messages=self._messages(dish_name, ingredients),
             max_tokens=500
         )
         
-        content = response.choices[0].message.content
+        return _parse_json(response.choices[0].message.content)
+    
+    @_retry_transient
+    async def acall(self, dish_name: str, ingredients: Union[List[str], str]) -> Dict[str, Any]:
+        return await _astream_json(
+            model="gpt-4o-mini",
+            response_format={"type": "json_object"},
+            messages=self._messages(dish_name, ingredients),
+            max_tokens=500
+        )
+    
+    # ----- Batch: varios platos en un solo prompt -----
+    
+    def _batch_messages(self, items: List[Tuple[str, List[str]]]) -> List[Dict[str, str]]:
+        dishes_str = "\n".join(
+            f"{i}. Plato: {dish_name} | Ingredientes: {', '.join(ingredients) if ingredients else 'ingredientes estándar'}"
+            for i, (dish_name, ingredients) in enumerate(items)
+        )
         
-        if "```json" in content:
-            json_str = content.split("```json")[1].split("```")[0].strip()
-        elif "```" in content:
-            json_str = content.split("```")[1].split("```")[0].strip()
-        else:
-            json_str = content.strip()
+        return [
+            {"role": "system", "content": _NUTRITION_SYSTEM_PROMPT},
+            {"role": "user", "content": _NUTRITION_BATCH_PROMPT_TMPL.format(dishes=dishes_str)}
+        ]
+    
+    @_retry_transient
+    async def abatch(self, items: List[Tuple[str, List[str]]]) -> List[Dict[str, Any]]:
+        response = await _acreate(
+            model="gpt-4o-mini",
+            response_format={"type": "json_object"},
+            messages=self._batch_messages(items),
+            max_tokens=min(500 * len(items), 16000),
+            timeout=_HTTP_TIMEOUT.read * len(items)
+        )
         
-        return json.loads(json_str)
+        return _parse_batch_results(response.choices[0].message.content, len(items), "resultados nutricionales")
 
 
 class DishComparisonTool:
@@ -121,224 +736,474 @@ class DishComparisonTool:
     name = "compare_dishes"
     description = "Compara dos platos cultural, nutricional y culinariamente"
     
-    def __call__(self, dish1: Dict[str, Any], dish2: Dict[str, Any]) -> Dict[str, Any]:
-        client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-        
+    def _messages(self, dish1: Dict[str, Any], dish2: Dict[str, Any]) -> List[Dict[str, str]]:
         dish1_ingredients = ", ".join(dish1['ingredients']) if isinstance(dish1['ingredients'], list) else dish1['ingredients']
         dish2_ingredients = ", ".join(dish2['ingredients']) if isinstance(dish2['ingredients'], list) else dish2['ingredients']
         
-        response = client.chat.completions.create(
+        return [
+            {"role": "system", "content": _COMPARE_SYSTEM_PROMPT},
+            {
+                "role": "user",
+                "content": _COMPARE_PROMPT_TMPL.format(
+                    dish1_name=dish1['name'],
+                    dish1_ingredients=dish1_ingredients,
+                    dish2_name=dish2['name'],
+                    dish2_ingredients=dish2_ingredients
+                )
+            }
+        ]
+    
+    @_retry_transient
+    def __call__(self, dish1: Dict[str, Any], dish2: Dict[str, Any]) -> Dict[str, Any]:
+        response = _create(
             model="gpt-4o-mini",
-            messages=[
-                {
-                    "role": "system",
-                    "content": "Eres un experto en gastronomía comparativa y análisis culinario transcultural."
-                },
-                {
-                    "role": "user",
-                    "content": f"""Compara estos dos platos en detalle:
-
-Plato 1: {dish1['name']}
-Ingredientes: {dish1_ingredients}
-
-Plato 2: {dish2['name']}
-Ingredientes: {dish2_ingredients}
-
-Responde en formato JSON:
-{{
-    "similarity_score": número_del_0_al_100,
-    "common_ingredients": ["ingrediente1", "ingrediente2"],
-    "unique_to_dish1": ["ingrediente_exclusivo_1"],
-    "unique_to_dish2": ["ingrediente_exclusivo_1"],
-    "culinary_relationship": "descripción de la relación culinaria entre ambos platos",
-    "cultural_context": "contexto cultural y origen de cada plato",
-    "key_differences": ["diferencia1", "diferencia2", "diferencia3"]
-}}"""
-                }
-            ],
+            response_format={"type": "json_object"},
+            messages=self._messages(dish1, dish2),
             max_tokens=800
         )
         
-        content = response.choices[0].message.content
-        
-        if "```json" in content:
-            json_str = content.split("```json")[1].split("```")[0].strip()
-        elif "```" in content:
-            json_str = content.split("```")[1].split("```")[0].strip()
-        else:
-            json_str = content.strip()
-        
-        return json.loads(json_str)
+        return _parse_json(response.choices[0].message.content)
+    
+    @_retry_transient
+    async def acall(self, dish1: Dict[str, Any], dish2: Dict[str, Any]) -> Dict[str, Any]:
+        return await _astream_json(
+            model="gpt-4o-mini",
+            response_format={"type": "json_object"},
+            messages=self._messages(dish1, dish2),
+            max_tokens=800
+        )
 
 
-# ============= SIGNATURES =============
+# ============= RESULTS =============
 
-class AnalyzeFoodImageSignature(dspy.Signature):
-    """
-    Analiza una imagen de comida para identificar el plato, ingredientes, receta y datos curiosos.
-    Usa capacidades de visión para entender el contenido visual.
-    """
-    image_description: str = dspy.InputField(desc="Descripción o contexto sobre la imagen de comida")
-    dish_name: str = dspy.OutputField(desc="Nombre del plato identificado en la imagen")
-    ingredients: List[str] = dspy.OutputField(desc="Lista de ingredientes principales del plato")
-    recipe_steps: List[str] = dspy.OutputField(desc="Pasos de la receta paso a paso")
-    fun_facts: List[str] = dspy.OutputField(desc="3-5 datos curiosos sobre el plato")
+# Resultados del agente como dataclasses con __slots__: ocupan menos memoria que un
+# dict por resultado (importante en analyze_many / get_nutrition_many) y, al ser
+# inmutables, se pueden compartir desde la caché sin copiarlos.
 
+@dataclass(slots=True, frozen=True)
+class AgentError:
+    error: str
+    success: bool = False
+    # True si el fallo es de la entrada (imagen no decodificable), no del agente
+    invalid_input: bool = False
 
-class CalculateNutritionSignature(dspy.Signature):
-    """
-    Calcula información nutricional para un plato basándose en sus ingredientes.
-    Proporciona estimaciones de calorías, macronutrientes y otros datos nutricionales.
-    """
-    dish_name: str = dspy.InputField(desc="Nombre del plato")
-    ingredients: str = dspy.InputField(desc="Lista de ingredientes separados por comas")
-    nutrition: Dict[str, Any] = dspy.OutputField(
-        desc="Datos nutricionales incluyendo calorías, proteínas, carbohidratos, grasas, fibra y tamaño de porción"
-    )
 
+@dataclass(slots=True, frozen=True)
+class AnalysisResult:
+    dish_name: str
+    ingredients: Tuple[str, ...]
+    recipe_steps: Tuple[str, ...]
+    fun_facts: Tuple[str, ...]
+    agent_reasoning: Optional[str]
+    tool_used: str
+    success: bool = True
+
+
+@dataclass(slots=True, frozen=True)
+class NutritionResult:
+    dish_name: str
+    nutrition: Dict[str, Any]
+    agent_reasoning: Optional[str]
+    tool_used: str
+    success: bool = True
 
-class CompareDishesSignature(dspy.Signature):
-    """
-    Compara dos platos cultural, nutricional y culinariamente para encontrar similitudes
-    y diferencias.
-    """
-    dish1_name: str = dspy.InputField(desc="Nombre del primer plato")
-    dish1_ingredients: str = dspy.InputField(desc="Ingredientes del primer plato")
-    dish2_name: str = dspy.InputField(desc="Nombre del segundo plato")
-    dish2_ingredients: str = dspy.InputField(desc="Ingredientes del segundo plato")
-    comparison: Dict[str, Any] = dspy.OutputField(
-        desc="Comparación incluyendo similarity_score, culinary_relationship, cultural_context y key_differences"
-    )
+
+@dataclass(slots=True, frozen=True)
+class NutritionBatchResult:
+    results: Tuple[NutritionResult, ...]
+    tool_used: str
+    success: bool = True
+
+
+@dataclass(slots=True, frozen=True)
+class ComparisonResult:
+    comparison: Dict[str, Any]
+    agent_reasoning: Optional[str]
+    tool_used: str
+    success: bool = True
 
 
 # ============= AGENT MODULE =============
 
-class FoodAnalyzerAgent(dspy.Module):
+class FoodAnalyzerAgent:
     """
     Agente principal para análisis de comida usando DSPy.
     Combina Tools (ejecución) con Signatures (razonamiento) para proporcionar
     análisis inteligentes de comida, nutrición y comparaciones.
     """
     
+    # Modelo barato y rápido para el razonamiento ChainOfThought de respaldo
+    REASONING_MODEL = "openai/gpt-4.1-nano"
+    REASONING_MAX_TOKENS = 300
+    
+    # Caché en disco de DSPy: sobrevive a reinicios; local al proyecto y acotada
+    # (el default de DSPy es ~/.dspy_cache con hasta 30 GB)
+    DSPY_CACHE_DIR = os.getenv("FOOD_DSPY_CACHE_DIR", ".dspy_cache")
+    DSPY_CACHE_LIMIT = 2 * 1024 ** 3
+    
     def __init__(self):
-        super().__init__()
-        
         # Inicializar Tools
         self.analyze_tool = AnalyzeFoodTool()
         self.nutrition_tool = NutritionCalculatorTool()
         self.comparison_tool = DishComparisonTool()
         
-        # Inicializar Signatures para razonamiento DSPy
-        self.analyze_food = dspy.ChainOfThought(AnalyzeFoodImageSignature)
-        self.calculate_nutrition = dspy.ChainOfThought(CalculateNutritionSignature)
-        self.compare_dishes = dspy.ChainOfThought(CompareDishesSignature)
+        # Solo con FOOD_VISION_BATCH_SIZE > 1: las peticiones de análisis concurrentes se
+        # agrupan en una sola llamada multi-imagen. Un 400/422 del lote (p. ej. una imagen
+        # inválida) no es transitorio: se reintenta cada imagen por separado
+        self.vision_batcher: Optional[MicroBatcher] = None
+        if VISION_BATCH_SIZE > 1:
+            self.vision_batcher = MicroBatcher(
+                self.analyze_tool.abatch,
+                self.analyze_tool.acall,
+                max_batch=VISION_BATCH_SIZE,
+                fallback_on=(ValueError, KeyError, BadRequestError, UnprocessableEntityError)
+            )
+        
+        # Caches de respuestas: exacto por entrada y semántico por nombre del plato
+        self._cache = _LRUCache()
+        self._semantic_cache = _SemanticCache()
+    
+    # ----- Módulos DSPy: se importan y construyen solo la primera vez que se usan -----
+    
+    @cached_property
+    def _reasoning_lm(self):
+        import dspy
+        
+        dspy.configure_cache(
+            enable_disk_cache=True,
+            disk_cache_dir=self.DSPY_CACHE_DIR,
+            disk_size_limit_bytes=self.DSPY_CACHE_LIMIT
+        )
+        
+        return dspy.LM(
+            self.REASONING_MODEL,
+            api_key=OPENAI_API_KEY,
+            max_tokens=self.REASONING_MAX_TOKENS
+        )
     
-    def analyze_image(self, image_base64: str, context: str = "") -> Dict[str, Any]:
+    def _chain_of_thought(self, signature_name: str):
+        import dspy
+        import signatures
+        
+        module = dspy.ChainOfThought(getattr(signatures, signature_name))
+        module.set_lm(self._reasoning_lm)
+        return module
+    
+    @cached_property
+    def analyze_food(self):
+        return self._chain_of_thought("AnalyzeFoodImageSignature")
+    
+    @cached_property
+    def calculate_nutrition(self):
+        return self._chain_of_thought("CalculateNutritionSignature")
+    
+    @cached_property
+    def compare_dishes(self):
+        return self._chain_of_thought("CompareDishesSignature")
+    
+    async def _reasoning(self, raw_result: Dict[str, Any], module_name: str,
+                         include_reasoning: bool = True, **inputs) -> Optional[str]:
+        # El tool ya devuelve su razonamiento en la misma llamada; ChainOfThought
+        # solo se ejecuta (y se construye) como respaldo si el modelo omitió el campo
+        # y quien llama necesita el razonamiento
+        reasoning = raw_result.pop("reasoning", None)
+        if reasoning or not include_reasoning:
+            return reasoning
+        
+        try:
+            module = getattr(self, module_name)
+            prediction = await asyncio.to_thread(module, **inputs)
+        except Exception:
+            # El razonamiento es complementario: si falla (p. ej. respuesta truncada), se omite
+            return None
+        return getattr(prediction, "reasoning", None) or getattr(prediction, "rationale", None)
+    
+    def _image_cache_key(self, image: Union[bytes, str], context: str,
+                         image_hash: Optional[str] = None) -> Tuple[str, Tuple[str, str, str]]:
+        # Los strings (base64 o URL, que puede llevar caracteres no ASCII) se hashean en UTF-8
+        if image_hash is None:
+            image_hash = _image_digest(image.encode("utf-8") if isinstance(image, str) else image)
+        return image_hash, ("image", image_hash, context)
+    
+    def _analysis_result(self, raw_result: Dict[str, Any], reasoning: Optional[str]) -> AnalysisResult:
+        return AnalysisResult(
+            dish_name=raw_result["dish_name"],
+            ingredients=tuple(raw_result["ingredients"]),
+            recipe_steps=tuple(raw_result["recipe_steps"]),
+            fun_facts=tuple(raw_result["fun_facts"]),
+            agent_reasoning=reasoning,
+            tool_used=self.analyze_tool.name
+        )
+    
+    async def analyze_image_async(self, image: Union[bytes, str], context: str = "",
+                                  include_reasoning: bool = False,
+                                  image_hash: Optional[str] = None) -> Union[AnalysisResult, AgentError]:
+        # include_reasoning=False (p. ej. /analyze_food, que no devuelve el razonamiento):
+        # nunca se paga la llamada ChainOfThought de respaldo.
+        # image_hash: SHA-256 de `image` si quien llama ya lo calculó; la imagen se hashea
+        # una sola vez y ese hash sirve tanto de clave de caché como para el data URL
         try:
-            # 1. Ejecutar tool para obtener análisis crudo
-            raw_result = self.analyze_tool(image_base64, context)
+            image_hash, cache_key = self._image_cache_key(image, context, image_hash)
+            cached = self._cache.get(cache_key)
+            if cached is not None and (cached.agent_reasoning or not include_reasoning):
+                return cached
             
-            # 2. Usar DSPy ChainOfThought para añadir razonamiento estructurado
+            # 1. Ejecutar tool (agrupado con otras peticiones si FOOD_VISION_BATCH_SIZE > 1) para obtener
+            #    el análisis crudo, que incluye el razonamiento
+            image_url = await _aimage_data_url(image, image_hash)
+            if self.vision_batcher is not None:
+                raw_result = await self.vision_batcher.submit(image_url)
+            else:
+                raw_result = await self.analyze_tool.acall(image_url)
+            
+            # 2. Razonamiento del tool, o DSPy ChainOfThought como respaldo si se pidió
             image_description = f"Plato analizado: {raw_result['dish_name']}"
             if context:
                 image_description += f". Contexto: {context}"
             
-            prediction = self.analyze_food(image_description=image_description)
+            reasoning = await self._reasoning(
+                raw_result,
+                "analyze_food",
+                include_reasoning,
+                image_description=image_description
+            )
             
-            return {
-                "success": True,
-                "dish_name": raw_result["dish_name"],
-                "ingredients": raw_result["ingredients"],
-                "recipe_steps": raw_result["recipe_steps"],
-                "fun_facts": raw_result["fun_facts"],
-                "agent_reasoning": prediction.rationale if hasattr(prediction, 'rationale') else None,
-                "tool_used": self.analyze_tool.name
-            }
+            result = self._analysis_result(raw_result, reasoning)
+            self._cache.set(cache_key, result)
+            return result
             
+        except InvalidImageError as e:
+            return AgentError(str(e), invalid_input=True)
         except Exception as e:
-            return {
-                "success": False,
-                "error": str(e)
-            }
+            return AgentError(str(e))
     
     
-    def get_nutrition(self, dish_name: str, ingredients: List[str] = None) -> Dict[str, Any]:
+    async def analyze_image_stream(self, image: Union[bytes, str], context: str = "",
+                                   image_hash: Optional[str] = None) -> AsyncIterator[Tuple[str, Any]]:
+        # Versión en streaming de analyze_image_async: produce (campo, valor) en cuanto cada
+        # campo del JSON está completo (dish_name, ingredients, recipe_steps, fun_facts, reasoning).
+        # No pasa por el micro-batcher: un lote no puede repartir el stream entre peticiones
+        image_hash, cache_key = self._image_cache_key(image, context, image_hash)
+        cached = self._cache.get(cache_key)
+        if cached is not None:
+            yield "dish_name", cached.dish_name
+            yield "ingredients", list(cached.ingredients)
+            yield "recipe_steps", list(cached.recipe_steps)
+            yield "fun_facts", list(cached.fun_facts)
+            yield "reasoning", cached.agent_reasoning
+            return
+        
+        image_url = await _aimage_data_url(image, image_hash)
+        queue: asyncio.Queue = asyncio.Queue()
+        task = asyncio.create_task(self.analyze_tool.astream(image_url, on_text=queue.put_nowait))
+        task.add_done_callback(lambda _: queue.put_nowait(None))
+        
+        chunks: List[str] = []
+        emitted = 0
+        try:
+            while (text := await queue.get()) is not None:
+                chunks.append(text)
+                # Con el esquema estricto los campos llegan en orden: el campo actual está
+                # completo cuando aparece la clave del siguiente (una clave entre comillas no
+                # puede aparecer sin escapar dentro de un valor string). Esa clave solo puede
+                # completarse con un fragmento que trae comillas: solo entonces se une el texto
+                if '"' not in text:
+                    continue
+                buf = "".join(chunks)
+                while emitted < len(_ANALYSIS_FIELDS) - 1:
+                    end = buf.find(f'"{_ANALYSIS_FIELDS[emitted + 1]}"')
+                    if end < 0:
+                        break
+                    try:
+                        value = _parse_json(buf[:end].rstrip().rstrip(",") + "}")[_ANALYSIS_FIELDS[emitted]]
+                    except (orjson.JSONDecodeError, KeyError):
+                        break
+                    yield _ANALYSIS_FIELDS[emitted], value
+                    emitted += 1
+            
+            raw_result = await task
+        finally:
+            task.cancel()
+        
+        for field in _ANALYSIS_FIELDS[emitted:]:
+            yield field, raw_result[field]
+        
+        self._cache.set(cache_key, self._analysis_result(raw_result, raw_result.get("reasoning")))
+    
+    async def analyze_many_async(self, images: List[Union[bytes, str]], context: str = "",
+                                 max_concurrency: int = 20,
+                                 include_reasoning: bool = False) -> List[Union[AnalysisResult, AgentError]]:
+        # Fan-out acotado: como mucho max_concurrency análisis en vuelo. RPM/TPM los respeta
+        # el limiter compartido en cada llamada real a la API (OPENAI_RPM / OPENAI_TPM)
+        semaphore = asyncio.Semaphore(max_concurrency)
+        
+        async def _analyze(image: Union[bytes, str]) -> Union[AnalysisResult, AgentError]:
+            async with semaphore:
+                return await self.analyze_image_async(image, context, include_reasoning)
+        
+        return await asyncio.gather(*(_analyze(image) for image in images))
+    
+    async def get_nutrition_async(self, dish_name: str, ingredients: List[str] = None) -> Union[NutritionResult, AgentError]:
         try:
-            # 1. Ejecutar tool para calcular nutrición
             if not ingredients:
                 ingredients = ["ingredientes estándar"]
             
-            nutrition_data = self.nutrition_tool(dish_name, ingredients)
-            
-            # 2. Usar DSPy ChainOfThought para añadir contexto y razonamiento
             ingredients_str = ", ".join(ingredients)
-            prediction = self.calculate_nutrition(
+            ingredients_key = _ingredients_key(ingredients)
+            cache_key = ("nutrition", dish_name.strip().lower(), ingredients_key)
+            cached = self._cache.get(cache_key)
+            if cached is not None:
+                # La clave ignora mayúsculas/espacios: devolver el nombre tal como se pidió
+                return replace(cached, dish_name=dish_name) if cached.dish_name != dish_name else cached
+            
+            # Caché semántico: se embebe solo el nombre del plato y los ingredientes deben
+            # coincidir exactamente. Si ninguna entrada tiene esos ingredientes no puede haber
+            # hit, y el embedding (solo necesario para guardar el resultado) va en paralelo
+            embedding = asyncio.ensure_future(self._semantic_cache.embed(dish_name.strip()))
+            if self._semantic_cache.has_key(ingredients_key):
+                cached = self._semantic_cache.match(await embedding, ingredients_key)
+                if cached is not None:
+                    # El resultado conserva el nombre pedido, no el de la consulta original
+                    cached = replace(cached, dish_name=dish_name)
+                    self._cache.set(cache_key, cached)
+                    return cached
+            
+            try:
+                nutrition_data = await self.nutrition_tool.acall(dish_name, ingredients_str)
+            except BaseException:
+                embedding.cancel()
+                raise
+            reasoning = await self._reasoning(
+                nutrition_data,
+                "calculate_nutrition",
                 dish_name=dish_name,
                 ingredients=ingredients_str
             )
             
-            return {
-                "success": True,
-                "dish_name": dish_name,
-                "nutrition": nutrition_data,
-                "agent_reasoning": prediction.rationale if hasattr(prediction, 'rationale') else None,
-                "tool_used": self.nutrition_tool.name
-            }
+            result = NutritionResult(
+                dish_name=dish_name,
+                nutrition=nutrition_data,
+                agent_reasoning=reasoning,
+                tool_used=self.nutrition_tool.name
+            )
+            self._cache.set(cache_key, result)
+            self._semantic_cache.add(await embedding, ingredients_key, result)
+            return result
             
         except Exception as e:
-            return {
-                "success": False,
-                "error": str(e)
-            }
+            return AgentError(str(e))
     
-    def compare(self, dish1_name: str, dish1_ingredients: List[str],
-                dish2_name: str, dish2_ingredients: List[str]) -> Dict[str, Any]:
+    async def get_nutrition_many_async(self, dishes: List[Tuple[str, List[str]]]) -> Union[NutritionBatchResult, AgentError]:
         try:
-            # 1. Ejecutar tool para comparar platos
-            dish1 = {"name": dish1_name, "ingredients": dish1_ingredients}
-            dish2 = {"name": dish2_name, "ingredients": dish2_ingredients}
+            # Un solo prompt para todos los platos: el system prompt se envía una vez
+            items = [(dish_name, ingredients or ["ingredientes estándar"]) for dish_name, ingredients in dishes]
+            nutrition_list = await self.nutrition_tool.abatch(items)
+            
+            return NutritionBatchResult(
+                results=tuple(
+                    NutritionResult(dish_name, nutrition, None, self.nutrition_tool.name)
+                    for (dish_name, _), nutrition in zip(items, nutrition_list)
+                ),
+                tool_used=self.nutrition_tool.name
+            )
             
-            comparison_data = self.comparison_tool(dish1, dish2)
+        except Exception as e:
+            return AgentError(str(e))
+    
+    async def compare_async(self, dish1_name: str, dish1_ingredients: List[str],
+                            dish2_name: str, dish2_ingredients: List[str]) -> Union[ComparisonResult, AgentError]:
+        cache_key = (
+            "compare",
+            dish1_name.strip().lower(), _ingredients_key(dish1_ingredients),
+            dish2_name.strip().lower(), _ingredients_key(dish2_ingredients)
+        )
+        cached = self._cache.get(cache_key)
+        if cached is not None:
+            return cached
+        
+        try:
+            # Los ingredientes se unen una sola vez y se comparten entre tool y ChainOfThought
+            dish1_ingredients_str = ", ".join(dish1_ingredients)
+            dish2_ingredients_str = ", ".join(dish2_ingredients)
+            dish1 = {"name": dish1_name, "ingredients": dish1_ingredients_str}
+            dish2 = {"name": dish2_name, "ingredients": dish2_ingredients_str}
             
-            # 2. Usar DSPy ChainOfThought para añadir análisis profundo
-            prediction = self.compare_dishes(
+            comparison_data = await self.comparison_tool.acall(dish1, dish2)
+            reasoning = await self._reasoning(
+                comparison_data,
+                "compare_dishes",
                 dish1_name=dish1_name,
-                dish1_ingredients=", ".join(dish1_ingredients),
+                dish1_ingredients=dish1_ingredients_str,
                 dish2_name=dish2_name,
-                dish2_ingredients=", ".join(dish2_ingredients)
+                dish2_ingredients=dish2_ingredients_str
             )
             
-            return {
-                "success": True,
-                "comparison": comparison_data,
-                "agent_reasoning": prediction.rationale if hasattr(prediction, 'rationale') else None,
-                "tool_used": self.comparison_tool.name
-            }
+            result = ComparisonResult(
+                comparison=comparison_data,
+                agent_reasoning=reasoning,
+                tool_used=self.comparison_tool.name
+            )
+            self._cache.set(cache_key, result)
+            return result
             
         except Exception as e:
-            return {
-                "success": False,
-                "error": str(e)
-            }
+            return AgentError(str(e))
+    
+    async def warmup(self):
+        # Abre por adelantado la conexión (DNS + TLS + HTTP/2) del pool compartido con
+        # una petición que no consume tokens, para que la primera petición real no la pague
+        try:
+            await _get_async_client().models.list()
+        except Exception:
+            pass
+    
+    # Wrappers síncronos para uso fuera de un event loop (scripts, CLI); ver _run_sync
+    
+    def analyze_image(self, image: Union[bytes, str], context: str = "",
+                      include_reasoning: bool = False) -> Union[AnalysisResult, AgentError]:
+        return _run_sync(self.analyze_image_async(image, context, include_reasoning))
+    
+    def analyze_many(self, images: List[Union[bytes, str]], context: str = "",
+                     max_concurrency: int = 20,
+                     include_reasoning: bool = False) -> List[Union[AnalysisResult, AgentError]]:
+        return _run_sync(self.analyze_many_async(images, context, max_concurrency, include_reasoning))
+    
+    def get_nutrition(self, dish_name: str, ingredients: List[str] = None) -> Union[NutritionResult, AgentError]:
+        return _run_sync(self.get_nutrition_async(dish_name, ingredients))
+    
+    def get_nutrition_many(self, dishes: List[Tuple[str, List[str]]]) -> Union[NutritionBatchResult, AgentError]:
+        return _run_sync(self.get_nutrition_many_async(dishes))
+    
+    def compare(self, dish1_name: str, dish1_ingredients: List[str],
+                dish2_name: str, dish2_ingredients: List[str]) -> Union[ComparisonResult, AgentError]:
+        return _run_sync(self.compare_async(dish1_name, dish1_ingredients,
+                                            dish2_name, dish2_ingredients))
 
 
-#SINGLETON
+#SINGLETON (double-checked locking: el threadpool de FastAPI puede llamar en paralelo)
 _agent_instance = None
+_agent_lock = threading.Lock()
 
 def get_agent() -> FoodAnalyzerAgent:
     global _agent_instance
     
-    if _agent_instance is None:
-        # Configure DSPy with OpenAI
-        api_key = os.getenv("OPENAI_API_KEY")
-        if not api_key:
-            raise ValueError("OPENAI_API_KEY not found in environment variables")
-        
-        lm = dspy.LM('openai/gpt-4o-mini', api_key=api_key)
-        dspy.configure(lm=lm)
-        
-        # Create agent instance
-        _agent_instance = FoodAnalyzerAgent()
+    if _agent_instance is not None:
+        return _agent_instance
+    
+    with _agent_lock:
+        if _agent_instance is None:
+            if not OPENAI_API_KEY:
+                raise ValueError("OPENAI_API_KEY not found in environment variables")
+            
+            # DSPy no se importa aquí: los módulos ChainOfThought llevan su propio LM
+            # y se construyen bajo demanda (ver FoodAnalyzerAgent._chain_of_thought)
+            
+            # Inicializar los clientes OpenAI compartidos
+            _get_client()
+            _get_async_client()
+            
+            # Create agent instance
+            _agent_instance = FoodAnalyzerAgent()
     
     return _agent_instance
 
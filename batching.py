@@ -0,0 +1,139 @@
+"""
+Batching module for Food Analyzer Agent
+Groups concurrent requests into a single batched LLM call (size + timeout)
+"""
+
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, List, Tuple, Type
+
+
+class MicroBatcher:
+    """
+    Agrupa peticiones concurrentes en lotes dinámicos.
+
+    Cada submit() encola un elemento; un worker por event loop espera hasta
+    `window` segundos a que lleguen más (como mucho `max_batch`) y los resuelve
+    con una única llamada a `call_batch`. Un lote de un solo elemento, o un lote
+    cuya respuesta llega incompleta o mal formada, se resuelve con `call_one`.
+    Como mucho hay `max_inflight` lotes en vuelo: mientras tanto la cola sigue
+    creciendo y el siguiente lote sale lleno (backpressure).
+
+    `fallback_on`: excepciones de `call_batch` tras las que cada elemento se reintenta
+    por separado con `call_one` (respuesta mal formada, o un elemento que la API
+    rechaza y no debe arrastrar al resto del lote). Cualquier otra se propaga a todos.
+    """
+
+    def __init__(self, call_batch: Callable[[List[Any]], Awaitable[List[Any]]],
+                 call_one: Callable[[Any], Awaitable[Any]],
+                 max_batch: int = 8, window: float = 0.02, max_inflight: int = 4,
+                 fallback_on: Tuple[Type[BaseException], ...] = (ValueError, KeyError)):
+        self.call_batch = call_batch
+        self.call_one = call_one
+        self.fallback_on = fallback_on
+        self.max_batch = max_batch
+        self.window = window
+        self.max_inflight = max_inflight
+
+        # Cola + worker por event loop (el de la API y el de los wrappers síncronos)
+        self._workers: Dict[asyncio.AbstractEventLoop, Tuple[asyncio.Queue, asyncio.Task]] = {}
+        self._inflight: set = set()
+
+    def start(self) -> None:
+        """Arranca el worker en el event loop actual (idempotente)."""
+        self._queue()
+
+    async def stop(self) -> None:
+        """
+        Detiene el worker del event loop actual: cancela las peticiones aún en cola y
+        espera a que terminen los lotes ya enviados (antes de cerrar los clientes HTTP).
+        """
+        loop = asyncio.get_running_loop()
+        worker = self._workers.pop(loop, None)
+        if worker is None:
+            return
+
+        queue, task = worker
+        task.cancel()
+        while not queue.empty():
+            _, future = queue.get_nowait()
+            future.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+        inflight = [t for t in self._inflight if t.get_loop() is loop]
+        await asyncio.gather(*inflight, return_exceptions=True)
+
+    def _queue(self) -> asyncio.Queue:
+        loop = asyncio.get_running_loop()
+        worker = self._workers.get(loop)
+        if worker is None:
+            for closed in [l for l in self._workers if l.is_closed()]:
+                del self._workers[closed]
+
+            queue = asyncio.Queue()
+            worker = (queue, loop.create_task(self._worker(queue)))
+            self._workers[loop] = worker
+        return worker[0]
+
+    async def submit(self, item: Any) -> Any:
+        future = asyncio.get_running_loop().create_future()
+        self._queue().put_nowait((item, future))
+        return await future
+
+    async def _worker(self, queue: asyncio.Queue):
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(self.max_inflight)
+
+        while True:
+            batch = []
+            try:
+                batch.append(await queue.get())
+                deadline = loop.time() + self.window
+
+                while len(batch) < self.max_batch:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+
+                await slots.acquire()
+            except asyncio.CancelledError:
+                # Peticiones ya sacadas de la cola pero sin enviar: no dejarlas colgadas
+                for _, future in batch:
+                    future.cancel()
+                raise
+
+            # El envío no bloquea al worker: mientras tanto se sigue armando el siguiente lote
+            task = loop.create_task(self._dispatch(batch))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+            task.add_done_callback(lambda _: slots.release())
+
+    async def _dispatch(self, batch: List[Tuple[Any, asyncio.Future]]):
+        items = [item for item, _ in batch]
+        if len(items) == 1:
+            # Un solo elemento: su error es definitivo, no hay lote que repartir
+            results = await asyncio.gather(self.call_one(items[0]), return_exceptions=True)
+        else:
+            results = await self._call_batch(items)
+
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    async def _call_batch(self, items: List[Any]) -> List[Any]:
+        try:
+            return await self.call_batch(items)
+        except self.fallback_on:
+            # Respuesta del lote incompleta/mal formada, o un elemento rechazado por la API:
+            # resolver cada elemento por separado para que el fallo quede solo en el suyo
+            return await asyncio.gather(*(self.call_one(item) for item in items),
+                                        return_exceptions=True)
+        except Exception as e:
+            return [e] * len(items)
@@ -4,15 +4,41 @@ Handles SQLite storage for food analyses and caching
 """
 
 import sqlite3
-import json
-from datetime import datetime
-from typing import Optional, List, Dict, Any
-import hashlib
+import orjson
+from typing import Optional, List, Dict
+import threading
+
+
+DB_PATH = "food_analyzer.db"
+
+# Una conexión por hilo: las lecturas concurrentes (event loop + hilos de to_thread)
+# no se serializan sobre una única conexión compartida; WAL permite leer mientras se escribe
+_local = threading.local()
+
+
+def get_conn() -> sqlite3.Connection:
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH)
+        conn.row_factory = sqlite3.Row  # Allow accessing columns by name
+        # PRAGMAs por conexión (journal_mode=WAL persiste en el archivo)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA mmap_size=268435456")  # 256 MB mapeados: lecturas sin read()
+        conn.execute("PRAGMA cache_size=-65536")    # 64 MB de caché de páginas
+        conn.execute("PRAGMA temp_store=MEMORY")    # tablas temporales / ORDER BY sin archivos temporales
+        _local.conn = conn
+    return conn
+
+
+def close_conn() -> None:
+    conn = getattr(_local, "conn", None)
+    if conn is not None:
+        conn.close()
+        _local.conn = None
 
 
 def setup_database() -> sqlite3.Connection:
-    conn = sqlite3.connect("food_analyzer.db", check_same_thread=False)
-    conn.row_factory = sqlite3.Row  # Allow accessing columns by name
+    conn = get_conn()
     cursor = conn.cursor()
 
     # --- Table 1: Food Analyses ---
@@ -28,24 +54,65 @@ def setup_database() -> sqlite3.Connection:
         );
     """)
 
+    # Índices para la caché por hash de imagen y para el historial (ORDER BY created_at)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_food_hash ON food_analyses(image_hash)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_food_created ON food_analyses(created_at DESC)")
+
+    # WAL: las lecturas no se bloquean mientras save_analysis escribe
+    cursor.execute("PRAGMA journal_mode=WAL")
+
     conn.commit()
     return conn
 
 
 # ============= FOOD ANALYSES FUNCTIONS =============
 
+# SQL constante a nivel de módulo: el mismo texto en cada llamada reutiliza el
+# statement ya preparado de la caché de sqlite3 de cada conexión
+_ANALYSIS_COLUMNS = "id, dish_name, ingredients, recipe_steps, fun_facts, created_at"
+
+SQL_INSERT_ANALYSIS = """
+    INSERT INTO food_analyses (dish_name, ingredients, recipe_steps, fun_facts, image_hash)
+    VALUES (?, ?, ?, ?, ?)
+"""
+SQL_HISTORY = """
+    SELECT id, dish_name, ingredients, created_at
+    FROM food_analyses
+    ORDER BY created_at DESC
+    LIMIT ?
+"""
+SQL_ANALYSIS_BY_ID = f"SELECT {_ANALYSIS_COLUMNS} FROM food_analyses WHERE id = ?"
+SQL_ANALYSIS_BY_HASH = f"SELECT {_ANALYSIS_COLUMNS} FROM food_analyses WHERE image_hash = ? LIMIT 1"
+# Plantilla: los placeholders dependen del número de ids (1-2 en la práctica, así que
+# la caché de statements de sqlite3 solo llega a guardar un par de variantes)
+SQL_ANALYSES_BY_IDS_TMPL = f"SELECT {_ANALYSIS_COLUMNS} FROM food_analyses WHERE id IN ({{placeholders}})"
+SQL_ALL_ANALYSES = """
+    SELECT id, dish_name, ingredients, created_at
+    FROM food_analyses
+    ORDER BY created_at DESC
+"""
+
+
+def _row_to_analysis(row: sqlite3.Row) -> Dict:
+    return {
+        "id": row["id"],
+        "dish_name": row["dish_name"],
+        "ingredients": orjson.loads(row["ingredients"]),
+        "recipe_steps": orjson.loads(row["recipe_steps"]),
+        "fun_facts": orjson.loads(row["fun_facts"]),
+        "created_at": row["created_at"]
+    }
+
+
 def save_analysis(conn: sqlite3.Connection, dish_name: str, ingredients: List[str],
                   recipe_steps: List[str], fun_facts: List[str],
                   image_hash: str = None) -> int:
     cursor = conn.cursor()
-    cursor.execute("""
-        INSERT INTO food_analyses (dish_name, ingredients, recipe_steps, fun_facts, image_hash)
-        VALUES (?, ?, ?, ?, ?)
-    """, (
+    cursor.execute(SQL_INSERT_ANALYSIS, (
         dish_name,
-        json.dumps(ingredients, ensure_ascii=False),
-        json.dumps(recipe_steps, ensure_ascii=False),
-        json.dumps(fun_facts, ensure_ascii=False),
+        orjson.dumps(ingredients).decode(),
+        orjson.dumps(recipe_steps).decode(),
+        orjson.dumps(fun_facts).decode(),
         image_hash
     ))
     conn.commit()
@@ -54,19 +121,15 @@ def save_analysis(conn: sqlite3.Connection, dish_name: str, ingredients: List[st
 
 def get_analysis_history(conn: sqlite3.Connection, limit: int = 10) -> List[Dict]:
     cursor = conn.cursor()
-    cursor.execute("""
-        SELECT id, dish_name, ingredients, created_at
-        FROM food_analyses
-        ORDER BY created_at DESC
-        LIMIT ?
-    """, (limit,))
+    cursor.execute(SQL_HISTORY, (limit,))
+    rows = cursor.fetchall()
     
     results = []
-    for row in cursor.fetchall():
+    for row in rows:
         results.append({
             "id": row["id"],
             "dish_name": row["dish_name"],
-            "ingredients": json.loads(row["ingredients"]),
+            "ingredients": orjson.loads(row["ingredients"]),
             "created_at": row["created_at"]
         })
     return results
@@ -74,37 +137,46 @@ def get_analysis_history(conn: sqlite3.Connection, limit: int = 10) -> List[Dict
 
 def get_analysis_by_id(conn: sqlite3.Connection, analysis_id: int) -> Optional[Dict]:
     cursor = conn.cursor()
-    cursor.execute("""
-        SELECT * FROM food_analyses WHERE id = ?
-    """, (analysis_id,))
+    cursor.execute(SQL_ANALYSIS_BY_ID, (analysis_id,))
+    row = cursor.fetchone()
+    
+    if row:
+        return _row_to_analysis(row)
+    return None
+
+
+def get_analyses_by_ids(conn: sqlite3.Connection, analysis_ids: List[int]) -> Dict[int, Dict]:
+    # Varios análisis en una sola consulta (p. ej. los dos platos de /compare)
+    placeholders = ",".join("?" * len(analysis_ids))
+    cursor = conn.cursor()
+    cursor.execute(SQL_ANALYSES_BY_IDS_TMPL.format(placeholders=placeholders), tuple(analysis_ids))
+    rows = cursor.fetchall()
     
+    return {row["id"]: _row_to_analysis(row) for row in rows}
+
+
+def get_analysis_by_hash(conn: sqlite3.Connection, image_hash: str) -> Optional[Dict]:
+    # Caché por contenido: una imagen ya analizada se resuelve sin llamar al modelo
+    cursor = conn.cursor()
+    cursor.execute(SQL_ANALYSIS_BY_HASH, (image_hash,))
     row = cursor.fetchone()
+    
     if row:
-        return {
-            "id": row["id"],
-            "dish_name": row["dish_name"],
-            "ingredients": json.loads(row["ingredients"]),
-            "recipe_steps": json.loads(row["recipe_steps"]),
-            "fun_facts": json.loads(row["fun_facts"]),
-            "created_at": row["created_at"]
-        }
+        return _row_to_analysis(row)
     return None
 
 
 def get_all_analyses(conn: sqlite3.Connection) -> List[Dict]:
     cursor = conn.cursor()
-    cursor.execute("""
-        SELECT id, dish_name, ingredients, created_at
-        FROM food_analyses
-        ORDER BY created_at DESC
-    """)
+    cursor.execute(SQL_ALL_ANALYSES)
+    rows = cursor.fetchall()
     
     results = []
-    for row in cursor.fetchall():
+    for row in rows:
         results.append({
             "id": row["id"],
             "dish_name": row["dish_name"],
-            "ingredients": json.loads(row["ingredients"]),
+            "ingredients": orjson.loads(row["ingredients"]),
             "created_at": row["created_at"]
         })
     return results
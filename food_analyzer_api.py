@@ -1,23 +1,55 @@
-import io
-import base64
-from fastapi import FastAPI, UploadFile, File, HTTPException
+import asyncio
+import hashlib
+from typing import Optional, Tuple
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request, UploadFile, File, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+import orjson
+from cachetools import TTLCache
 from pydantic import BaseModel
-from PIL import Image, UnidentifiedImageError
 from dotenv import load_dotenv
-from agent import get_agent
+from agent import get_agent, aclose_clients, InvalidImageError
 from tools import calculate_nutrition, compare_dishes_from_db
 import database as db
 
 load_dotenv()
 
-# Initialize database
-db_conn = db.setup_database()
+# Initialize database (cada hilo abre su propia conexión con db.get_conn())
+db.setup_database()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Startup: crear el agente y calentar sus conexiones antes de la primera petición
+    agent = None
+    try:
+        agent = get_agent()
+        await agent.warmup()
+    except ValueError:
+        # Sin OPENAI_API_KEY la API arranca igual; los endpoints del agente devolverán 500
+        pass
+    
+    # Worker del batcher de visión (si está activado) en el event loop del servidor
+    if agent is not None and agent.vision_batcher is not None:
+        agent.vision_batcher.start()
+    
+    yield
+    
+    # Shutdown
+    if agent is not None and agent.vision_batcher is not None:
+        await agent.vision_batcher.stop()
+    await aclose_clients()
+    db.close_conn()
+
 
 app = FastAPI(
     title="Food Analyzer Agent API",
     version="1.0.0",
-    description="API con agente inteligente DSPy para análisis de comida con base de datos SQLite"
+    description="API con agente inteligente DSPy para análisis de comida con base de datos SQLite",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
 # Configurar CORS para permitir cualquier origen
@@ -29,6 +61,35 @@ app.add_middleware(
     allow_headers=["*"],  
 )
 
+# Comprimir respuestas grandes (historial, análisis con recetas); las pequeñas no compensan
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+
+
+# Respuestas ya serializadas de /analyze_food por SHA-256 de la imagen: un duplicado
+# reciente se responde sin tocar la BD ni volver a serializar
+_response_cache: TTLCache = TTLCache(maxsize=1024, ttl=3600)
+
+MAX_UPLOAD_BYTES = 10 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# Firmas de los formatos que acepta el modelo de visión (JPEG, PNG, GIF, WEBP)
+_IMAGE_SIGNATURES = (b"\xff\xd8\xff", b"\x89PNG\r\n\x1a\n", b"GIF87a", b"GIF89a")
+
+
+def _is_supported_image(data: bytes) -> bool:
+    return data.startswith(_IMAGE_SIGNATURES) or (data[:4] == b"RIFF" and data[8:12] == b"WEBP")
+
+
+ANALYZE_CONTEXT = "Analiza esta imagen de comida. Muchas imágenes serán sobre comida tradicional de diferentes culturas."
+
+# Eventos SSE de /analyze_food/stream: campo del agente -> clave de la respuesta
+_SSE_FIELDS = {
+    "dish_name": "nombre_plato",
+    "ingredients": "ingredientes",
+    "recipe_steps": "pasos",
+    "fun_facts": "datos_curiosos"
+}
+
 
 class Recipe(BaseModel):
     ingredientes: list[str]
@@ -41,63 +102,160 @@ class FoodAnalysisResponse(BaseModel):
     datos_curiosos: list[str]
 
 
-@app.post("/analyze_food", response_model=FoodAnalysisResponse)
-async def analyze_food(file: UploadFile = File(...)):
+def _analysis_response(dish_name: str, ingredients, recipe_steps, fun_facts) -> ORJSONResponse:
+    # Se serializa directamente a JSON: al devolver un Response, FastAPI no construye ni
+    # valida FoodAnalysisResponse en cada petición (el modelo queda solo para la documentación)
+    return ORJSONResponse({
+        "nombre_plato": dish_name,
+        "receta": {
+            "ingredientes": ingredients,
+            "pasos": recipe_steps
+        },
+        "datos_curiosos": fun_facts
+    })
+
+
+def _etag_response(request: Request, payload, cache_control: str = "private, max-age=60") -> Response:
+    # ETag = SHA-256 del cuerpo serializado: si el cliente ya tiene esa versión
+    # (If-None-Match) se responde 304 sin cuerpo
+    body = orjson.dumps(payload)
+    etag = f'"{hashlib.sha256(body).hexdigest()}"'
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        if "*" in tags or etag in tags:
+            return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+async def _read_image_upload(file: UploadFile) -> Tuple[bytearray, str]:
+    # Valida y lee la subida; devuelve los bytes de la imagen y su SHA-256
     if not file.content_type or not file.content_type.startswith("image/"):
         raise HTTPException(
             status_code=415, 
             detail="El archivo debe ser una imagen"
         )
     
-    try:
-        img_bytes = await file.read()
-        img_stream = io.BytesIO(img_bytes)
-        img_obj = Image.open(img_stream)
-        
-        # Validar que se pueda abrir como imagen
-        img_obj.verify()
-        
-    except UnidentifiedImageError:
+    too_large = file.size is not None and file.size > MAX_UPLOAD_BYTES
+    if too_large:
+        raise HTTPException(
+            status_code=413,
+            detail="La imagen supera el tamaño máximo permitido (10 MB)"
+        )
+    
+    # Validar por firma (magic bytes) con los primeros bytes, antes de leer el resto:
+    # un archivo que no es imagen se rechaza sin cargarlo ni decodificarlo con PIL
+    head = await file.read(16)
+    if not _is_supported_image(head):
         raise HTTPException(
             status_code=415, 
             detail="No se pudo procesar la imagen"
         )
     
-    # Convertir imagen a base64
-    img_stream.seek(0)
-    base64_image = base64.b64encode(img_stream.read()).decode('utf-8')
+    # Lectura por bloques con tope: una subida enorme no llega a cargarse entera en memoria.
+    # El SHA-256 se calcula bloque a bloque durante la lectura, sin una segunda pasada
+    buf = bytearray(head)
+    hasher = hashlib.sha256(head)
+    while not too_large and (chunk := await file.read(UPLOAD_CHUNK_SIZE)):
+        hasher.update(chunk)
+        buf.extend(chunk)
+        too_large = len(buf) > MAX_UPLOAD_BYTES
+    
+    if too_large:
+        raise HTTPException(
+            status_code=413,
+            detail="La imagen supera el tamaño máximo permitido (10 MB)"
+        )
+    # El bytearray se devuelve tal cual (hash y base64 aceptan cualquier buffer):
+    # bytes(buf) haría una segunda copia completa de la imagen
+    return buf, hasher.hexdigest()
+
+
+async def _cached_analysis_body(image_hash: str) -> Optional[bytes]:
+    # Respuesta ya serializada de una imagen analizada antes (caché en memoria o BD),
+    # o None si hay que llamar al modelo
+    body = _response_cache.get(image_hash)
+    if body is not None:
+        return body
+    
+    # Las lecturas de SQLite van a un hilo para no bloquear el event loop
+    cached = await asyncio.to_thread(lambda: db.get_analysis_by_hash(db.get_conn(), image_hash))
+    if not cached:
+        return None
+    
+    body = _analysis_response(
+        cached["dish_name"],
+        cached["ingredients"],
+        cached["recipe_steps"],
+        cached["fun_facts"]
+    ).body
+    _response_cache[image_hash] = body
+    return body
+
+
+async def _save_analysis(image_hash: str, dish_name: str, ingredients, recipe_steps, fun_facts) -> None:
+    # El INSERT + commit va a un hilo para no bloquear el event loop; la conexión
+    # se obtiene dentro del hilo que la usa
+    await asyncio.to_thread(
+        lambda: db.save_analysis(
+            db.get_conn(),
+            dish_name=dish_name,
+            ingredients=ingredients,
+            recipe_steps=recipe_steps,
+            fun_facts=fun_facts,
+            image_hash=image_hash
+        )
+    )
+
+
+@app.post("/analyze_food", response_model=FoodAnalysisResponse)
+async def analyze_food(file: UploadFile = File(...)):
+    img_bytes, image_hash = await _read_image_upload(file)
+    
+    # Imagen ya analizada: responder sin llamar al modelo
+    body = await _cached_analysis_body(image_hash)
+    if body is not None:
+        return Response(content=body, media_type="application/json")
     
     try:
         # Usar el agente DSPy para análisis inteligente
         agent = get_agent()
-        context = "Analiza esta imagen de comida. Muchas imágenes serán sobre comida tradicional de diferentes culturas."
         
-        agent_result = agent.analyze_image(base64_image, context=context)
+        # El agente codifica los bytes a base64 una sola vez y reutiliza el hash ya calculado
+        agent_result = await agent.analyze_image_async(img_bytes, context=ANALYZE_CONTEXT, image_hash=image_hash)
         
-        if not agent_result["success"]:
+        if not agent_result.success:
+            # Cabecera válida pero contenido no decodificable: es un error de la subida
+            if agent_result.invalid_input:
+                raise HTTPException(
+                    status_code=415, 
+                    detail="No se pudo procesar la imagen"
+                )
             raise HTTPException(
                 status_code=500,
-                detail=f"Error del agente: {agent_result.get('error', 'Unknown error')}"
+                detail=f"Error del agente: {agent_result.error}"
             )
         
         # Guardar en base de datos
-        analysis_id = db.save_analysis(
-            db_conn,
-            dish_name=agent_result["dish_name"],
-            ingredients=agent_result["ingredients"],
-            recipe_steps=agent_result["recipe_steps"],
-            fun_facts=agent_result["fun_facts"]
+        await _save_analysis(
+            image_hash,
+            agent_result.dish_name,
+            agent_result.ingredients,
+            agent_result.recipe_steps,
+            agent_result.fun_facts
         )
         
         # Retornar resultado estructurado
-        return FoodAnalysisResponse(
-            nombre_plato=agent_result["dish_name"],
-            receta=Recipe(
-                ingredientes=agent_result["ingredients"],
-                pasos=agent_result["recipe_steps"]
-            ),
-            datos_curiosos=agent_result["fun_facts"]
+        response = _analysis_response(
+            agent_result.dish_name,
+            agent_result.ingredients,
+            agent_result.recipe_steps,
+            agent_result.fun_facts
         )
+        _response_cache[image_hash] = response.body
+        return response
         
     except HTTPException:
         raise
@@ -109,12 +267,85 @@ async def analyze_food(file: UploadFile = File(...)):
 
 
 
+def _sse(event: str, data: bytes) -> bytes:
+    return b"event: " + event.encode() + b"\ndata: " + data + b"\n\n"
+
+
+async def _sse_from_body(body: bytes):
+    # Análisis ya conocido (caché o BD): todos los eventos de una vez
+    data = orjson.loads(body)
+    yield _sse("dish_name", orjson.dumps({"nombre_plato": data["nombre_plato"]}))
+    yield _sse("ingredients", orjson.dumps({"ingredientes": data["receta"]["ingredientes"]}))
+    yield _sse("recipe_steps", orjson.dumps({"pasos": data["receta"]["pasos"]}))
+    yield _sse("fun_facts", orjson.dumps({"datos_curiosos": data["datos_curiosos"]}))
+    yield _sse("done", body)
+
+
+async def _sse_from_agent(agent, img_bytes: bytearray, image_hash: str):
+    fields = {}
+    try:
+        async for field, value in agent.analyze_image_stream(img_bytes, context=ANALYZE_CONTEXT,
+                                                             image_hash=image_hash):
+            fields[field] = value
+            if field in _SSE_FIELDS:
+                yield _sse(field, orjson.dumps({_SSE_FIELDS[field]: value}))
+        
+        await _save_analysis(
+            image_hash,
+            fields["dish_name"],
+            fields["ingredients"],
+            fields["recipe_steps"],
+            fields["fun_facts"]
+        )
+    except InvalidImageError:
+        # Los headers (200) ya se enviaron: el error viaja como evento, con el status equivalente
+        yield _sse("error", orjson.dumps({"status_code": 415, "detail": "No se pudo procesar la imagen"}))
+        return
+    except Exception as e:
+        yield _sse("error", orjson.dumps({"status_code": 500, "detail": f"Error al analizar la imagen: {str(e)}"}))
+        return
+    
+    response = _analysis_response(
+        fields["dish_name"],
+        fields["ingredients"],
+        fields["recipe_steps"],
+        fields["fun_facts"]
+    )
+    _response_cache[image_hash] = response.body
+    yield _sse("done", response.body)
+
+
+@app.post("/analyze_food/stream")
+async def analyze_food_stream(file: UploadFile = File(...)):
+    """
+    Igual que /analyze_food, pero responde con Server-Sent Events: el cliente recibe
+    cada campo (dish_name, ingredients, recipe_steps, fun_facts) en cuanto el modelo
+    lo termina, y un evento final `done` con la respuesta completa.
+    """
+    img_bytes, image_hash = await _read_image_upload(file)
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    
+    body = await _cached_analysis_body(image_hash)
+    if body is not None:
+        return StreamingResponse(_sse_from_body(body), media_type="text/event-stream", headers=headers)
+    
+    try:
+        agent = get_agent()
+    except ValueError as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error al analizar la imagen: {str(e)}"
+        )
+    return StreamingResponse(_sse_from_agent(agent, img_bytes, image_hash),
+                             media_type="text/event-stream", headers=headers)
+
+
 @app.get("/nutrition/{dish_name}")
-async def get_nutrition(dish_name: str, ingredients: str = None):
+async def get_nutrition(request: Request, dish_name: str, ingredients: str = None):
     try:
-        ingredient_list = ingredients.split(",") if ingredients else None
-        result = calculate_nutrition(dish_name, ingredient_list)
-        return result
+        ingredient_list = [i.strip() for i in ingredients.split(",") if i.strip()] if ingredients else None
+        result = await calculate_nutrition(dish_name, ingredient_list)
+        return _etag_response(request, result)
     except Exception as e:
         raise HTTPException(
             status_code=500,
@@ -125,7 +356,7 @@ async def get_nutrition(dish_name: str, ingredients: str = None):
 @app.get("/compare")
 async def compare_two_dishes(analysis_id1: int, analysis_id2: int):
     try:
-        result = compare_dishes_from_db(analysis_id1, analysis_id2, db_conn)
+        result = await compare_dishes_from_db(analysis_id1, analysis_id2)
         return result
     except Exception as e:
         raise HTTPException(
@@ -135,10 +366,13 @@ async def compare_two_dishes(analysis_id1: int, analysis_id2: int):
 
 
 @app.get("/history")
-async def get_history(limit: int = 10):
+async def get_history(request: Request, limit: int = 10):
     try:
-        history = db.get_analysis_history(db_conn, limit=limit)
-        return {"history": history, "count": len(history)}
+        history = await asyncio.to_thread(lambda: db.get_analysis_history(db.get_conn(), limit=limit))
+        # El historial cambia con cada análisis nuevo: no-cache obliga a revalidar
+        # siempre (304 si no cambió) en lugar de reutilizar una copia vieja
+        return _etag_response(request, {"history": history, "count": len(history)},
+                              cache_control="no-cache")
     except Exception as e:
         raise HTTPException(
             status_code=500,
@@ -147,7 +381,7 @@ async def get_history(limit: int = 10):
 
 
 @app.get("/analysis/{analysis_id}")
-async def get_analysis(analysis_id: int):
+async def get_analysis(request: Request, analysis_id: int):
     """
     Obtiene un análisis específico por ID.
     
@@ -155,10 +389,11 @@ async def get_analysis(analysis_id: int):
         analysis_id: ID del análisis
     """
     try:
-        analysis = db.get_analysis_by_id(db_conn, analysis_id)
+        analysis = await asyncio.to_thread(lambda: db.get_analysis_by_id(db.get_conn(), analysis_id))
         if not analysis:
             raise HTTPException(status_code=404, detail="Análisis no encontrado")
-        return analysis
+        # Un análisis guardado no cambia: los clientes pueden cachearlo más tiempo
+        return _etag_response(request, analysis, cache_control="private, max-age=3600")
     except HTTPException:
         raise
     except Exception as e:
@@ -176,6 +411,7 @@ def root():
         "description": "API con agente inteligente DSPy + Base de datos SQLite",
         "endpoints": {
             "POST /analyze_food": "Analiza una imagen de comida y la guarda en BD",
+            "POST /analyze_food/stream": "Igual que /analyze_food, con resultados parciales vía SSE",
             "GET /nutrition/{dish_name}": "Calcula información nutricional",
             "GET /compare?analysis_id1=X&analysis_id2=Y": "Compara dos platos guardados en BD",
             "GET /history": "Obtiene historial de análisis guardados",
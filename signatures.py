@@ -0,0 +1,46 @@
+"""
+Signatures module for Food Analyzer Agent
+DSPy signatures used by the agent's ChainOfThought reasoning modules.
+Imported lazily by agent.py so DSPy is only loaded when it is needed.
+"""
+
+import dspy
+from typing import List, Dict, Any
+
+
+class AnalyzeFoodImageSignature(dspy.Signature):
+    """
+    Analiza una imagen de comida para identificar el plato, ingredientes, receta y datos curiosos.
+    Usa capacidades de visión para entender el contenido visual.
+    """
+    image_description: str = dspy.InputField(desc="Descripción o contexto sobre la imagen de comida")
+    dish_name: str = dspy.OutputField(desc="Nombre del plato identificado en la imagen")
+    ingredients: List[str] = dspy.OutputField(desc="Lista de ingredientes principales del plato")
+    recipe_steps: List[str] = dspy.OutputField(desc="Pasos de la receta paso a paso")
+    fun_facts: List[str] = dspy.OutputField(desc="3-5 datos curiosos sobre el plato")
+
+
+class CalculateNutritionSignature(dspy.Signature):
+    """
+    Calcula información nutricional para un plato basándose en sus ingredientes.
+    Proporciona estimaciones de calorías, macronutrientes y otros datos nutricionales.
+    """
+    dish_name: str = dspy.InputField(desc="Nombre del plato")
+    ingredients: str = dspy.InputField(desc="Lista de ingredientes separados por comas")
+    nutrition: Dict[str, Any] = dspy.OutputField(
+        desc="Datos nutricionales incluyendo calorías, proteínas, carbohidratos, grasas, fibra y tamaño de porción"
+    )
+
+
+class CompareDishesSignature(dspy.Signature):
+    """
+    Compara dos platos cultural, nutricional y culinariamente para encontrar similitudes
+    y diferencias.
+    """
+    dish1_name: str = dspy.InputField(desc="Nombre del primer plato")
+    dish1_ingredients: str = dspy.InputField(desc="Ingredientes del primer plato")
+    dish2_name: str = dspy.InputField(desc="Nombre del segundo plato")
+    dish2_ingredients: str = dspy.InputField(desc="Ingredientes del segundo plato")
+    comparison: Dict[str, Any] = dspy.OutputField(
+        desc="Comparación incluyendo similarity_score, culinary_relationship, cultural_context y key_differences"
+    )
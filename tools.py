@@ -3,29 +3,48 @@ Tools module for Food Analyzer Agent
 Contains utility functions that the agent uses
 """
 
+import asyncio
 from typing import Dict, Any, List
 from agent import get_agent
 import database as db
 
 
-def calculate_nutrition(dish_name: str, ingredients: List[str] = None) -> Dict[str, Any]:
-    agent = get_agent()
-    result = agent.get_nutrition(dish_name, ingredients)
+# El agente se resuelve una vez y se reutiliza en todas las funciones; no se crea al
+# importar el módulo para que la API pueda arrancar sin OPENAI_API_KEY
+_AGENT = None
+
+
+def _agent():
+    global _AGENT
+    if _AGENT is None:
+        _AGENT = get_agent()
+    return _AGENT
+
+
+async def calculate_nutrition(dish_name: str, ingredients: List[str] = None) -> Dict[str, Any]:
+    result = await _agent().get_nutrition_async(dish_name, ingredients)
     
-    if result["success"]:
+    if result.success:
         return {
-            "dish_name": result["dish_name"],
-            "nutrition": result["nutrition"],
-            "agent_reasoning": result.get("agent_reasoning"),
+            "dish_name": result.dish_name,
+            "nutrition": result.nutrition,
+            "agent_reasoning": result.agent_reasoning,
             "source": "agent"
         }
     else:
-        raise Exception(f"Agent error: {result.get('error', 'Unknown error')}")
+        raise Exception(f"Agent error: {result.error}")
+
+
+def _fetch_analyses(*analysis_ids: int) -> Dict[int, Dict[str, Any]]:
+    # Se ejecuta en un hilo del pool: usa la conexión SQLite propia de ese hilo
+    return db.get_analyses_by_ids(db.get_conn(), list(analysis_ids))
 
 
-def compare_dishes_from_db(analysis_id1: int, analysis_id2: int, conn) -> Dict[str, Any]:
-    analysis1 = db.get_analysis_by_id(conn, analysis_id1)
-    analysis2 = db.get_analysis_by_id(conn, analysis_id2)
+async def compare_dishes_from_db(analysis_id1: int, analysis_id2: int) -> Dict[str, Any]:
+    # Los dos platos se leen con una sola consulta (WHERE id IN) fuera del event loop
+    analyses = await asyncio.to_thread(_fetch_analyses, analysis_id1, analysis_id2)
+    analysis1 = analyses.get(analysis_id1)
+    analysis2 = analyses.get(analysis_id2)
     
     if not analysis1:
         raise Exception(f"Análisis con ID {analysis_id1} no encontrado")
@@ -33,15 +52,14 @@ def compare_dishes_from_db(analysis_id1: int, analysis_id2: int, conn) -> Dict[s
         raise Exception(f"Análisis con ID {analysis_id2} no encontrado")
     
     # Use agent to compare
-    agent = get_agent()
-    result = agent.compare(
+    result = await _agent().compare_async(
         analysis1["dish_name"],
         analysis1["ingredients"],
         analysis2["dish_name"],
         analysis2["ingredients"]
     )
     
-    if result["success"]:
+    if result.success:
         return {
             "dish1": {
                 "id": analysis1["id"],
@@ -53,12 +71,12 @@ def compare_dishes_from_db(analysis_id1: int, analysis_id2: int, conn) -> Dict[s
                 "name": analysis2["dish_name"],
                 "ingredients": analysis2["ingredients"]
             },
-            "comparison": result["comparison"],
-            "agent_reasoning": result.get("agent_reasoning"),
+            "comparison": result.comparison,
+            "agent_reasoning": result.agent_reasoning,
             "source": "database"
         }
     else:
-        raise Exception(f"Agent error: {result.get('error', 'Unknown error')}")
+        raise Exception(f"Agent error: {result.error}")
 
 
 # Test functions